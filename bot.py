@@ -1,17 +1,23 @@
 import asyncio
 import logging
 import os
-from decimal import Decimal, getcontext, ROUND_HALF_UP
+import re
+import time
+from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 
 import aiohttp
+import ijson
+import orjson
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, ContextTypes, PersistenceInput, PicklePersistence
 
-getcontext().prec = 28
-getcontext().rounding = ROUND_HALF_UP
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
 log = logging.getLogger("crypto_price_bot")
@@ -20,32 +26,71 @@ DEFAULT_FIAT = "usd"
 DEFAULT_SOURCE = "coingecko"
 SUPPORTED_FIAT = {"usd", "eur"}
 SUPPORTED_SOURCES = {"coingecko", "binance"}
+FIAT_SIGN = {"usd": "$", "eur": "€"}
+VALID_SYMBOL = re.compile(r"^[A-Z0-9]{1,10}$")
 
-user_fiat: Dict[int, str] = {}
-user_source: Dict[int, str] = {}
-
-cg_symbol_to_id: Dict[str, str] = {}
+_cg_state: Dict[str, Dict[str, str]] = {"sym_to_id": {}}
+_cg_warm_lock = asyncio.Lock()
 cg_cache_ready = asyncio.Event()
 
-def fmt_money(x: Decimal, fiat: str) -> str:
-    q = Decimal("0.00000001") if x < 1 else Decimal("0.01")
-    s = f"{x.quantize(q):f}"
+CG_SYMBOLS_CACHE = Path("cg_symbols.json")
+CG_SYMBOLS_TTL = 24 * 3600
+
+def load_symbols_cache() -> Optional[Dict[str, str]]:
+    try:
+        if time.time() - CG_SYMBOLS_CACHE.stat().st_mtime > CG_SYMBOLS_TTL:
+            return None
+        return orjson.loads(CG_SYMBOLS_CACHE.read_bytes())["m"]
+    except (OSError, orjson.JSONDecodeError, KeyError, TypeError):
+        return None
+
+def save_symbols_cache(mapping: Dict[str, str]) -> None:
+    try:
+        CG_SYMBOLS_CACHE.write_bytes(orjson.dumps({"t": time.time(), "m": mapping}))
+    except OSError as e:
+        log.warning("Failed to save CoinGecko symbols cache: %s", e)
+
+PRICE_CACHE_TTL = 10.0
+PRICE_CACHE_MAXSIZE = 2048
+price_cache: Dict[Tuple[str, str, str], Tuple[float, object]] = {}
+
+def cache_get(key: Tuple[str, str, str]):
+    entry = price_cache.get(key)
+    if entry is None:
+        return None
+    expires, value = entry
+    if expires < time.monotonic():
+        del price_cache[key]
+        return None
+    return value
+
+def cache_put(key: Tuple[str, str, str], value) -> None:
+    now = time.monotonic()
+    if len(price_cache) >= PRICE_CACHE_MAXSIZE:
+        for k in [k for k, (exp, _) in price_cache.items() if exp < now]:
+            del price_cache[k]
+        if len(price_cache) >= PRICE_CACHE_MAXSIZE:
+            del price_cache[next(iter(price_cache))]
+    price_cache[key] = (now + PRICE_CACHE_TTL, value)
+
+def fmt_money(x: float, fiat: str) -> str:
+    s = f"{x:.8f}" if x < 1 else f"{x:,.2f}"
     if "." in s:
         s = s.rstrip("0").rstrip(".")
-    sym = "$" if fiat.lower() == "usd" else "€"
-    return f"{sym}{s}"
+    return f"{FIAT_SIGN.get(fiat.lower(), '€')}{s}"
 
-def fmt_change(pct: Optional[Decimal]) -> str:
+def fmt_change(pct: Optional[float]) -> str:
     if pct is None:
         return "—"
-    sign = "▲" if pct >= 0 else "▼"
-    return f"{sign} {pct.quantize(Decimal('0.01'))}%"
+    return f"{'▲' if pct >= 0 else '▼'} {pct:.2f}%"
 
 def code(s: str) -> str:
     return f"<code>{s}</code>"
 
+_ESCAPE_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
 def escape(s: str) -> str:
-    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return s.translate(_ESCAPE_TABLE)
 
 class CoinGeckoClient:
     BASE = "https://api.coingecko.com/api/v3"
@@ -54,75 +99,163 @@ class CoinGeckoClient:
         self.session = session
 
     async def warm_symbols(self) -> None:
-        global cg_symbol_to_id
-        try:
-            url = f"{self.BASE}/coins/list?include_platform=false"
-            async with self.session.get(url, timeout=30) as r:
-                r.raise_for_status()
-                coins = await r.json()
-                mapping = {}
-                for c in coins:
-                    sym = str(c.get("symbol", "")).strip().lower()
-                    cid = str(c.get("id", "")).strip().lower()
-                    if sym and cid and sym not in mapping:
-                        mapping[sym] = cid
-                cg_symbol_to_id = mapping
-                log.info("CoinGecko symbols loaded: %d", len(mapping))
-        except Exception as e:
-            log.exception("Failed to load CoinGecko symbols: %s", e)
-        finally:
-            cg_cache_ready.set()
-
-    async def prices(self, symbols: List[str], fiat: str):
-        await cg_cache_ready.wait()
-        ids = [cg_symbol_to_id.get(s.lower()) for s in symbols if cg_symbol_to_id.get(s.lower())]
-        if not ids:
-            return {s.lower(): (None, None) for s in symbols}
-
-        params = {"ids": ",".join(ids), "vs_currencies": fiat.lower(), "include_24hr_change": "true"}
+        async with _cg_warm_lock:
+            try:
+                mapping = await asyncio.to_thread(load_symbols_cache)
+                if mapping is not None:
+                    log.info("CoinGecko symbols loaded from %s: %d", CG_SYMBOLS_CACHE, len(mapping))
+                else:
+                    url = f"{self.BASE}/coins/list?include_platform=false"
+                    mapping = {}
+                    async with self.session.get(url, timeout=30) as r:
+                        r.raise_for_status()
+                        # Build the map while the multi-MB body streams in instead of buffering it whole.
+                        async for c in ijson.items(r.content, "item"):
+                            sym = str(c.get("symbol", "")).strip().lower()
+                            cid = str(c.get("id", "")).strip().lower()
+                            if sym and cid and sym not in mapping:
+                                mapping[sym] = cid
+                    await asyncio.to_thread(save_symbols_cache, mapping)
+                    log.info("CoinGecko symbols loaded: %d", len(mapping))
+                _cg_state["sym_to_id"] = mapping
+            except Exception as e:
+                log.exception("Failed to load CoinGecko symbols: %s", e)
+            finally:
+                cg_cache_ready.set()
+
+    async def prices(self, symbols: List[str], fiat: str) -> List[Tuple[Optional[float], Optional[float]]]:
+        syms_lc = [s.lower() for s in symbols]
+        fiat_lc = fiat.lower()
+        change_key = f"{fiat_lc}_24h_change"
+
+        out = {}
+        misses = []
+        for s in syms_lc:
+            hit = cache_get(("coingecko", fiat_lc, s))
+            if hit is not None:
+                out[s] = hit
+            else:
+                misses.append(s)
+        if not misses:
+            return [out[s] for s in syms_lc]
+
+        # The map is filled once at startup; skip the extra reschedule after that.
+        if not cg_cache_ready.is_set():
+            await cg_cache_ready.wait()
+        sym_to_id = _cg_state["sym_to_id"]
+        sym_by_id = {sym_to_id[s]: s for s in misses if s in sym_to_id}
+        if not sym_by_id:
+            return [out.get(s, (None, None)) for s in syms_lc]
+
+        params = {"ids": ",".join(sym_by_id), "vs_currencies": fiat_lc, "include_24hr_change": "true"}
         url = f"{self.BASE}/simple/price"
         async with self.session.get(url, params=params, timeout=20) as r:
             if r.status != 200:
-                return {s.lower(): (None, None) for s in symbols}
-            data = await r.json()
+                return [out.get(s, (None, None)) for s in syms_lc]
+            data = orjson.loads(await r.read())
 
-        id_by_sym = {v: k for k, v in cg_symbol_to_id.items()}
-        out = {}
         for cid, payload in data.items():
-            sym = id_by_sym.get(cid, cid)
-            price_raw = payload.get(fiat.lower())
-            ch_raw = payload.get(f"{fiat.lower()}_24h_change")
-            price = Decimal(str(price_raw)) if price_raw is not None else None
-            change = Decimal(str(ch_raw)) if ch_raw is not None else None
+            sym = sym_by_id.get(cid)
+            if sym is None:
+                continue
+            price_raw = payload.get(fiat_lc)
+            ch_raw = payload.get(change_key)
+            price = float(price_raw) if price_raw is not None else None
+            change = float(ch_raw) if ch_raw is not None else None
             out[sym] = (price, change)
-        return out
+            if price is not None:
+                cache_put(("coingecko", fiat_lc, sym), (price, change))
+        return [out.get(s, (None, None)) for s in syms_lc]
 
 class BinanceClient:
     BASE = "https://api.binance.com"
+    PAIR_SUFFIX = {"usd": "USDT", "eur": "EUR"}
 
     def __init__(self, session: aiohttp.ClientSession):
         self.session = session
 
-    @staticmethod
-    def _pair(symbol: str, fiat: str) -> Optional[str]:
-        s = symbol.upper()
-        if fiat.lower() == "usd":
-            return f"{s}USDT"
-        elif fiat.lower() == "eur":
-            return f"{s}EUR"
-        return None
+    @classmethod
+    def _pair(cls, symbol: str, fiat: str) -> Optional[str]:
+        suffix = cls.PAIR_SUFFIX.get(fiat.lower())
+        return symbol.upper() + suffix if suffix else None
 
-    async def price(self, symbol: str, fiat: str) -> Optional[Decimal]:
+    async def price(self, symbol: str, fiat: str) -> Optional[float]:
         pair = self._pair(symbol, fiat)
         if not pair:
             return None
+        key = ("binance", fiat.lower(), symbol.lower())
+        cached = cache_get(key)
+        if cached is not None:
+            return cached
         url = f"{self.BASE}/api/v3/ticker/price"
         async with self.session.get(url, params={"symbol": pair}, timeout=15) as r:
             if r.status != 200:
                 return None
-            data = await r.json()
+            data = orjson.loads(await r.read())
             p = data.get("price")
-            return Decimal(str(p)) if p is not None else None
+            if p is None:
+                return None
+            price = float(p)
+            cache_put(key, price)
+            return price
+
+    async def prices(self, symbols: List[str], fiat: str) -> Dict[str, Optional[float]]:
+        fiat_lc = fiat.lower()
+        suffix = self.PAIR_SUFFIX.get(fiat_lc)
+        if not suffix:
+            return {s.lower(): None for s in symbols}
+
+        out: Dict[str, Optional[float]] = {}
+        sym_by_pair: Dict[str, str] = {}
+        for s in symbols:
+            s_lc = s.lower()
+            cached = cache_get(("binance", fiat_lc, s_lc))
+            if cached is not None:
+                out[s_lc] = cached
+            else:
+                sym_by_pair[s.upper() + suffix] = s_lc
+        if not sym_by_pair:
+            return out
+
+        url = f"{self.BASE}/api/v3/ticker/price"
+        params = {"symbols": orjson.dumps(list(sym_by_pair)).decode()}
+        invalid_symbol = False
+        data = None
+        try:
+            async with self.session.get(url, params=params, timeout=15) as r:
+                body = orjson.loads(await r.read())
+                if r.status == 200:
+                    data = body
+                elif r.status == 400 and isinstance(body, dict):
+                    invalid_symbol = body.get("code") == -1121
+        except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+            log.warning("Binance batch price request failed: %s", e)
+
+        if data is None:
+            misses = list(sym_by_pair.values())
+            if not invalid_symbol:
+                # Rate limits and server errors: retrying per symbol would only make things worse.
+                for s in misses:
+                    out[s] = None
+                return out
+            # Binance rejects the whole batch if any pair is unknown; fall back to one call per symbol.
+            results = await asyncio.gather(*(self.price(s, fiat) for s in misses), return_exceptions=True)
+            for s, price in zip(misses, results):
+                if isinstance(price, BaseException):
+                    log.warning("Binance price failed for %s: %s", s, price)
+                    price = None
+                out[s] = price
+            return out
+
+        for item in data:
+            sym = sym_by_pair.get(item.get("symbol"))
+            p = item.get("price")
+            if sym is None or p is None:
+                continue
+            price = float(p)
+            out[sym] = price
+            cache_put(("binance", fiat_lc, sym), price)
+        return out
 
 WELCOME = (
     "Привет! Я бот цен криптовалют.\n\n"
@@ -142,7 +275,7 @@ async def fiat_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if val not in SUPPORTED_FIAT:
         await update.message.reply_html("Поддерживаю только USD или EUR.")
         return
-    user_fiat[update.effective_user.id] = val
+    context.user_data["fiat"] = val
     await update.message.reply_html(f"Базовая валюта: {code(val.upper())}")
 
 async def source_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -153,59 +286,87 @@ async def source_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if val not in SUPPORTED_SOURCES:
         await update.message.reply_html("Источник: coingecko или binance.")
         return
-    user_source[update.effective_user.id] = val
+    context.user_data["source"] = val
     await update.message.reply_html(f"Источник цен: {code(val)}")
 
-def get_user_pref(uid: int):
-    fiat = user_fiat.get(uid, DEFAULT_FIAT)
-    source = user_source.get(uid, DEFAULT_SOURCE)
+def get_user_pref(context: ContextTypes.DEFAULT_TYPE):
+    fiat = context.user_data.get("fiat", DEFAULT_FIAT)
+    source = context.user_data.get("source", DEFAULT_SOURCE)
     return fiat, source
 
 async def price_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    uid = update.effective_user.id
-    fiat, source = get_user_pref(uid)
+    fiat, source = get_user_pref(context)
 
-    if not context.args:
+    tokens = [a.strip().upper() for a in context.args if a.strip()]
+    symbols = [s for s in tokens if VALID_SYMBOL.match(s)]
+    if not tokens:
         await update.message.reply_html(f"Пример: {code('/price btc eth sol')}")
         return
 
-    symbols = [s.strip().upper() for s in context.args if s.strip()]
-    async with aiohttp.ClientSession() as session:
-        cg = CoinGeckoClient(session)
-        bn = BinanceClient(session)
-        if source == "coingecko":
-            data = await cg.prices(symbols, fiat)
-            out_lines = []
-            for s in symbols:
-                price, change = data.get(s.lower(), (None, None))
-                if price is None:
-                    out_lines.append(f"{code(s)} — не найдено")
-                else:
-                    out_lines.append(f"{code(s)}: {fmt_money(price, fiat)} ({fmt_change(change)})")
-        else:
-            out_lines = []
-            for s in symbols:
-                price = await bn.price(s, fiat)
-                if price is None:
-                    out_lines.append(f"{code(s)} — не найдено")
-                else:
-                    out_lines.append(f"{code(s)}: {fmt_money(price, fiat)}")
+    session: aiohttp.ClientSession = context.bot_data["session"]
+    lines: Dict[str, str] = {}
+    if symbols and source == "coingecko":
+        data = await CoinGeckoClient(session).prices(symbols, fiat)
+        for s, (price, change) in zip(symbols, data):
+            if price is not None:
+                lines[s] = f"{code(s)}: {fmt_money(price, fiat)} ({fmt_change(change)})"
+    elif symbols:
+        data = await BinanceClient(session).prices(symbols, fiat)
+        for s in symbols:
+            price = data.get(s.lower())
+            if price is not None:
+                lines[s] = f"{code(s)}: {fmt_money(price, fiat)}"
+    out_lines = [lines.get(s) or f"{code(escape(s))} — не найдено" for s in tokens]
 
     msg = f"<b>Источник:</b> {source} | <b>Фиат:</b> {fiat.upper()}\n" + "\n".join(out_lines)
     await update.message.reply_html(msg)
 
-async def main():
+async def post_init(app: Application) -> None:
+    session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=20),
+        connector=aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=20,
+            ttl_dns_cache=600,
+            keepalive_timeout=60,
+            enable_cleanup_closed=True,
+        ),
+    )
+    app.bot_data["session"] = session
+    # Keep a reference: the loop only holds tasks weakly.
+    app.bot_data["warmup"] = asyncio.create_task(CoinGeckoClient(session).warm_symbols())
+
+async def post_shutdown(app: Application) -> None:
+    warmup = app.bot_data.pop("warmup", None)
+    if warmup is not None and not warmup.done():
+        warmup.cancel()
+        try:
+            await warmup
+        except asyncio.CancelledError:
+            pass
+    session = app.bot_data.pop("session", None)
+    if session is not None:
+        await session.close()
+
+def main():
     load_dotenv()
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
         raise RuntimeError("Добавьте TELEGRAM_BOT_TOKEN в .env")
 
-    app = Application.builder().token(token).build()
-
-    async def warmup():
-        async with aiohttp.ClientSession() as s:
-            await CoinGeckoClient(s).warm_symbols()
-    asyncio.create_task(warmup())
+    # Only user preferences are persisted; bot_data holds the live HTTP session.
+    persistence = PicklePersistence(
+        "bot_state.pkl",
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+    )
+    app = (
+        Application.builder()
+        .token(token)
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("fiat", fiat_cmd))
@@ -213,10 +374,13 @@ async def main():
     app.add_handler(CommandHandler("price", price_cmd))
 
     log.info("Bot started")
-    await app.run_polling(close_loop=False)
+    app.run_polling()
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        # run_polling() picks up the current loop via asyncio.get_event_loop().
+        asyncio.set_event_loop(uvloop.new_event_loop())
     try:
-        asyncio.run(main())
+        main()
     except (KeyboardInterrupt, SystemExit):
         pass